@@ -0,0 +1,173 @@
+import mmap
+import os
+import socket
+import stat
+import struct
+import time
+import typing as t
+import uuid
+import zlib
+
+from state import Position
+
+
+class Checkpoint:
+    """
+    Compact server state, stored in a memory-mapped file.
+
+    The file contains a header followed by one fixed-size record per client. The
+    header is written last and contains a checksum of the records, such that a
+    checkpoint that was interrupted mid-write is ignored.
+    """
+
+    MAGIC = b"CCCP"
+    VERSION = 1
+    # magic, version, checksum, client count, saved at, frame
+    HEADER = struct.Struct("<4sHIIdq")
+    # client ID, IPv4 host, port, x, y, vx, vy
+    CLIENT = struct.Struct("<16s4sHiiii")
+    SIZE = 1 << 20
+
+    def __init__(self, path: str | None = None, port: int = 5260) -> None:
+        """
+        By default, the checkpoint file name includes the server port, such that
+        multiple servers can run on the same machine.
+
+        Restored clients are trusted, so the checkpoint is stored in a private
+        directory, and we refuse to use files that other users could have written.
+        """
+        if path is None:
+            path = os.environ.get("GAME_SERVER_CHECKPOINT") or os.path.join(
+                get_private_directory(), f"cubblecobble-{port}.checkpoint"
+            )
+        self.path = path
+        # Number of times the checkpoint was saved by this process
+        self.saves = 0
+        # Don't follow symbolic links, which could point to any file
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            status = os.fstat(fd)
+            if not stat.S_ISREG(status.st_mode) or not is_private(status):
+                raise PermissionError(f"Refusing to use checkpoint file: {path}")
+            if status.st_size < self.SIZE:
+                os.ftruncate(fd, self.SIZE)
+            self.mmap = mmap.mmap(fd, self.SIZE)
+        finally:
+            os.close(fd)
+
+    def save(
+        self, frame: int, clients: t.Iterable[tuple[str, t.Any, Position]]
+    ) -> None:
+        """
+        Each client is a (client ID, address, position) tuple.
+        """
+        offset = self.HEADER.size
+        count = 0
+        for client_id, address, position in clients:
+            if offset + self.CLIENT.size > self.SIZE:
+                print(f"WARNING too many clients to checkpoint: {count}")
+                break
+            host, port = address
+            self.CLIENT.pack_into(
+                self.mmap,
+                offset,
+                uuid.UUID(client_id).bytes,
+                socket.inet_aton(host),
+                port,
+                position.x,
+                position.y,
+                position.vx,
+                position.vy,
+            )
+            offset += self.CLIENT.size
+            count += 1
+        with memoryview(self.mmap) as view:
+            checksum = zlib.crc32(view[self.HEADER.size : offset])
+        self.HEADER.pack_into(
+            self.mmap,
+            0,
+            self.MAGIC,
+            self.VERSION,
+            checksum,
+            count,
+            time.time(),
+            frame,
+        )
+        self.saves += 1
+
+    def load(
+        self, max_age: float
+    ) -> tuple[int, float, list[tuple[str, t.Any, Position]]] | None:
+        """
+        Return the frame, save time and clients from the last checkpoint. Return None if there is
+        no valid checkpoint that was saved in the last `max_age` seconds.
+        """
+        header = self.read_header(max_age)
+        if header is None:
+            return None
+        frame, saved_at, end = header
+        clients = []
+        for client_id, host, port, *values in self.CLIENT.iter_unpack(
+            self.mmap[self.HEADER.size : end]
+        ):
+            position = Position()
+            position.x, position.y, position.vx, position.vy = values
+            clients.append(
+                (
+                    str(uuid.UUID(bytes=client_id)),
+                    (socket.inet_ntoa(host), port),
+                    position,
+                )
+            )
+        return frame, saved_at, clients
+
+    def read_header(self, max_age: float) -> tuple[int, float, int] | None:
+        """
+        Return the checkpoint frame, save time and the end offset of the client
+        records, if the checkpoint is valid.
+        """
+        magic, version, checksum, count, saved_at, frame = self.HEADER.unpack_from(
+            self.mmap, 0
+        )
+        if magic != self.MAGIC or version != self.VERSION:
+            return None
+        if saved_at < time.time() - max_age:
+            print(f"INFO ignoring outdated checkpoint from {time.ctime(saved_at)}")
+            return None
+        end = self.HEADER.size + count * self.CLIENT.size
+        if end > self.SIZE:
+            return None
+        with memoryview(self.mmap) as view:
+            if zlib.crc32(view[self.HEADER.size : end]) != checksum:
+                print("WARNING ignoring corrupted checkpoint")
+                return None
+        return frame, saved_at, end
+
+    def invalidate(self) -> None:
+        """
+        Make sure that the current checkpoint is never restored.
+        """
+        self.mmap[: len(self.MAGIC)] = bytes(len(self.MAGIC))
+
+
+def get_private_directory() -> str:
+    """
+    Return a directory that only the current user can write to. Contrary to the
+    shared temporary directory, other users cannot create files there.
+    """
+    directory = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "cubblecobble"
+    )
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    return directory
+
+
+def is_private(status: os.stat_result) -> bool:
+    """
+    Check that a file belongs to the current user, and that other users cannot write
+    to it.
+    """
+    if status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        return False
+    # There are no user IDs on Windows
+    return not hasattr(os, "getuid") or status.st_uid == os.getuid()
@@ -0,0 +1,130 @@
+import typing as t
+import uuid
+
+import constants
+from ratelimit import RateLimiter
+from timers import TimerWheel
+
+
+class Client:
+    __slots__ = ("address", "inputs", "latency", "ping_time")
+
+    def __init__(self, address: t.Any) -> None:
+        self.address = address
+        # Each series of inputs is (frame, client_id, inputs)
+        # This list should be kept sorted by frame.
+        self.inputs: list[tuple[int, str, list[int]]] = []
+        # Number of frames between the server and the last state received from the
+        # client, which is a rough estimate of the client latency.
+        self.latency = 0
+        # Time of the last ping received during this tick. Pings are answered once, at
+        # the end of the tick.
+        self.ping_time: float | None = None
+
+
+class Clients:
+    """
+    Players connected to the game server, indexed by client ID and by address.
+
+    Clients are removed when their timer expires. Timers are refreshed every time we
+    hear from the client.
+
+    Each connection allocates a new player, so connections are much more limited than
+    other messages. They are rate-limited per host, and not per address, because a
+    single host may use as many ports as it wants.
+    """
+
+    # Get rid of clients that we haven't seen in a long while
+    TIMEOUT_FRAMES = 5 * constants.FPS
+    MAX_CLIENTS = 64
+    MAX_CONNECTS_PER_TICK = 4
+    CONNECT_RATE_LIMIT_PER_SECOND = 1
+    CONNECT_RATE_LIMIT_BURST = 2
+    MAX_RATE_LIMITED_HOSTS = 10000
+
+    def __init__(self) -> None:
+        self.clients: dict[str, Client] = {}
+        # Each address may own at most one client
+        self.ids_by_address: dict[t.Any, str] = {}
+        self.timeouts: TimerWheel[str] = TimerWheel()
+        self.connect_rate_limiter = RateLimiter(
+            self.CONNECT_RATE_LIMIT_PER_SECOND,
+            self.CONNECT_RATE_LIMIT_BURST,
+            self.MAX_RATE_LIMITED_HOSTS,
+        )
+        self.connects_this_tick = 0
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.clients
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def __getitem__(self, client_id: str) -> Client:
+        return self.clients[client_id]
+
+    def items(self) -> t.ItemsView[str, Client]:
+        return self.clients.items()
+
+    def get_id(self, address: t.Any) -> str | None:
+        """
+        Return the ID of the client that owns this address, if any.
+        """
+        return self.ids_by_address.get(address)
+
+    def allow_connect(self, address: t.Any, now: float) -> bool:
+        allowed: bool = self.connect_rate_limiter.allow(address[0], now)
+        return allowed
+
+    @property
+    def is_full(self) -> bool:
+        """
+        New clients cannot connect while this is true.
+        """
+        return (
+            self.connects_this_tick >= self.MAX_CONNECTS_PER_TICK
+            or len(self.clients) >= self.MAX_CLIENTS
+        )
+
+    def connect(self, address: t.Any) -> str:
+        """
+        Create a new client and return its ID.
+        """
+        self.connects_this_tick += 1
+        client_id = str(uuid.uuid4())
+        self.add(client_id, address)
+        return client_id
+
+    def add(self, client_id: str, address: t.Any) -> None:
+        self.clients[client_id] = Client(address)
+        self.ids_by_address[address] = client_id
+        self.refresh(client_id)
+
+    def refresh(self, client_id: str) -> None:
+        """
+        Postpone client removal.
+        """
+        self.timeouts.schedule(client_id, self.TIMEOUT_FRAMES)
+
+    def set_address(self, client_id: str, address: t.Any) -> None:
+        client = self.clients[client_id]
+        if client.address == address:
+            return
+        if self.ids_by_address.get(client.address) == client_id:
+            self.ids_by_address.pop(client.address)
+        self.ids_by_address[address] = client_id
+        client.address = address
+
+    def advance(self) -> list[str]:
+        """
+        Move on to the next tick. Outdated clients are removed, and their IDs are
+        returned.
+        """
+        self.connects_this_tick = 0
+        self.connect_rate_limiter.advance()
+        expired: list[str] = self.timeouts.advance()
+        for client_id in expired:
+            client = self.clients.pop(client_id)
+            if self.ids_by_address.get(client.address) == client_id:
+                self.ids_by_address.pop(client.address)
+        return expired
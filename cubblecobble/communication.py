@@ -9,12 +9,15 @@ COMMAND_KEY = "command"
 COMMAND_CONNECT = "connect"
 COMMAND_PING = "ping"
 COMMAND_STATE = "state"
+COMMAND_SPECTATE = "spectate"
 CLIENT_ID_KEY = "client_id"
 TIME_KEY = "time"
 DATA_KEY = "data"
 FRAME_KEY = "frame"
 INPUTS_KEY = "inputs"
 STATE_KEY = "state"
+CHECKSUM_KEY = "checksum"
+NONCE_KEY = "nonce"
 
 
 def create_server_socket(host: str, port: int) -> socket.socket:
@@ -50,30 +53,66 @@ def _create_blocking_udp_socket() -> socket.socket:
 def receive_all(s: socket.socket) -> t.Iterator[tuple[dict[str, t.Any], t.Any]]:
     """
     Iterate on received messages.
-    Attempt to read JSON-formatted data. In case no data is available, return None, None.
+    Attempt to read JSON-formatted data. Invalid messages are skipped.
     """
     while True:
-        try:
-            encoded, address = s.recvfrom(BUFFER_SIZE)
-        except BlockingIOError:
+        received = receive(s)
+        if received is None:
             # No more messages
             return
-        try:
-            decoded = encoded.decode()
-        except UnicodeDecodeError:
-            print(f"WARNING cannot decode data of length {len(encoded)}")
-            continue
-        try:
-            parsed = json.loads(decoded)
-        except json.JSONDecodeError:
-            print(f"WARNING cannot parse JSON from data of length {len(decoded)}")
-            continue
-        if not isinstance(parsed, dict):
-            print(f"WARNING parsed data is not valid dict {parsed}")
+        encoded, address = received
+        parsed = decode(encoded)
+        if parsed is None:
             continue
         yield parsed, address
 
 
+def receive(s: socket.socket) -> tuple[bytes, t.Any] | None:
+    """
+    Read a single raw message. In case no data is available, return None.
+    """
+    try:
+        return s.recvfrom(BUFFER_SIZE)
+    except BlockingIOError:
+        return None
+
+
+def is_message(encoded: bytes) -> bool:
+    """
+    Cheap check performed before we attempt to decode any data: all messages are
+    JSON-formatted dicts.
+    """
+    return encoded.startswith(b"{") and encoded.endswith(b"}")
+
+
+def is_command(encoded: bytes, command: str) -> bool:
+    """
+    Check the command of an encoded message without decoding it. This only works with
+    messages that were encoded with `encode_command`, where the command comes first.
+    """
+    return encoded.startswith(b'{"' + COMMAND_KEY.encode() + b'": "' + command.encode())
+
+
+def decode(encoded: bytes) -> dict[str, t.Any] | None:
+    """
+    Parse a JSON-formatted message. Return None if the data is invalid.
+    """
+    try:
+        decoded = encoded.decode()
+    except UnicodeDecodeError:
+        print(f"WARNING cannot decode data of length {len(encoded)}")
+        return None
+    try:
+        parsed = json.loads(decoded)
+    except json.JSONDecodeError:
+        print(f"WARNING cannot parse JSON from data of length {len(decoded)}")
+        return None
+    if not isinstance(parsed, dict):
+        print(f"WARNING parsed data is not valid dict {parsed}")
+        return None
+    return parsed
+
+
 def send_command(
     s: socket.socket, command: str, data: dict[str, t.Any], address: t.Any = None
 ) -> None:
@@ -82,13 +121,24 @@ def send_command(
 
     If no address argument, then the message will be sent to the server that the client is connected to.
     """
-    message = json.dumps({COMMAND_KEY: command, DATA_KEY: data}).encode()
+    send_message(s, encode_command(command, data), address)
+
+
+def send_message(s: socket.socket, message: bytes, address: t.Any = None) -> None:
+    """
+    Send an already encoded command, which is useful when the same message is sent to
+    many addresses.
+    """
     if address:
         s.sendto(message, address)
     else:
         s.send(message)
 
 
+def encode_command(command: str, data: dict[str, t.Any]) -> bytes:
+    return json.dumps({COMMAND_KEY: command, DATA_KEY: data}).encode()
+
+
 def parse_command(message: dict[str, t.Any]) -> tuple[str, dict[str, t.Any]]:
     """
     Parse command and data (arguments) fields in JSON message.
@@ -6,19 +6,28 @@ import pyxel
 
 import communication
 import constants
+from profiler import Profiler
+from spectators import Subscription
 from state import Commands, State
 
 
-def run() -> None:
+def run(
+    profiler: Profiler | None = None,
+    spectator: bool = False,
+    host: str | None = None,
+    port: int | None = None,
+) -> None:
     """
     Run a client instance, which will try to connect to a server.
+
+    Spectators don't play: they may connect to a game server or to a relay.
     """
-    game = Game()
-    game.run()
+    game = Spectator(host, port) if spectator else Game(host, port)
+    game.run(profiler)
 
 
 class Game:
-    def __init__(self) -> None:
+    def __init__(self, host: str | None = None, port: int | None = None) -> None:
         pyxel.init(
             constants.LEVEL_SIZE_PIXELS,
             constants.LEVEL_SIZE_PIXELS,
@@ -37,16 +46,22 @@ class Game:
         # Store inputs
         # Each entry is a (frame, inputs) tuple.
         self.inputs: list[tuple[int, list[int]]] = []
+        # Store the checksum of the predicted state at the end of each frame
+        self.checksums: dict[int, int] = {}
 
         # Establish connection with server
         # Communicate with server
         self.client_id = ""
-        self.socket = communication.create_client_socket()
-        self.send_command(communication.COMMAND_CONNECT, {})
-
-    def run(self) -> None:
-        pyxel.run(self.update, self.draw)
+        self.socket = communication.create_client_socket(host, port)
 
+    def run(self, profiler: Profiler | None = None) -> None:
+        """
+        The game loop, including state updates received from the server, is profiled.
+        """
+        update = self.update
+        if profiler:
+            update = profiler.wrap(update)
+        pyxel.run(update, self.draw)
 
     def update(self) -> None:
         # Handle restart command here
@@ -56,11 +71,8 @@ class Game:
         #     # Restart
         #     self.state = State()
 
-        # Send a ping once per second to check round-trip time (RTT)
         if self.frame % constants.FPS == 0:
-            self.send_command(
-                communication.COMMAND_PING, {communication.TIME_KEY: time()}
-            )
+            self.heartbeat()
 
         # Don't do anything until we have received a successful connect from the server
         if self.client_id:
@@ -87,6 +99,15 @@ class Game:
             # Apply all actions
             self.state.set_inputs(self.client_id, inputs)
             self.state.update()
+            self.checksums[self.frame] = self.state.checksum
+
+            # Forget about old checksums, in case we stopped receiving states from the
+            # server. Checksums are (mostly) inserted in frame order.
+            while self.checksums:
+                oldest_frame = next(iter(self.checksums))
+                if oldest_frame >= self.frame - constants.FPS:
+                    break
+                self.checksums.pop(oldest_frame)
 
         # We do this after the update, such that server has as much time as possible to
         # respond, but before drawing, such that what we display is as accurate as
@@ -96,18 +117,34 @@ class Game:
         # Move on to next frame
         self.frame += 1
 
+    def heartbeat(self) -> None:
+        """
+        Called once per second. Send a ping to check round-trip time (RTT). Until we
+        are connected, we keep trying to connect, because the server may silently
+        refuse connections.
+        """
+        if not self.client_id:
+            self.send_command(communication.COMMAND_CONNECT, {})
+        else:
+            self.send_command(
+                communication.COMMAND_PING, {communication.TIME_KEY: time()}
+            )
+
     def draw(self) -> None:
         if self.client_id:
             self.state.draw()
         else:
-            pyxel.cls(constants.BLACK)
-            host, port = self.socket.getpeername()
-            pyxel.text(
-                20,
-                constants.LEVEL_SIZE_PIXELS // 2 - 10,
-                f"Connecting to\n{host}:{port}...",
-                constants.WHITE,
-            )
+            self.draw_connecting()
+
+    def draw_connecting(self) -> None:
+        pyxel.cls(constants.BLACK)
+        host, port = self.socket.getpeername()
+        pyxel.text(
+            20,
+            constants.LEVEL_SIZE_PIXELS // 2 - 10,
+            f"Connecting to\n{host}:{port}...",
+            constants.WHITE,
+        )
 
     def receive_from_server(self) -> None:
         for message, _address in communication.receive_all(self.socket):
@@ -119,13 +156,21 @@ class Game:
                 self.on_ping(data)
             elif command == communication.COMMAND_STATE:
                 self.on_state(data)
+            elif command == communication.COMMAND_SPECTATE:
+                self.on_spectate(data)
             else:
                 print(f"WARNING unknow command from server: '{command}'")
 
+    def on_spectate(self, _data: dict[str, t.Any]) -> None:
+        print("WARNING unexpected spectate command from server")
+
     def on_connect(self, data: dict[str, t.Any]) -> None:
         client_id = data.get(communication.CLIENT_ID_KEY)
         if not client_id:
             raise ValueError(f"Received invalid client ID from server: {client_id}")
+        if self.client_id:
+            # Response to a connection retry
+            return
         self.client_id = client_id
         self.state.add_client(self.client_id)
         print(f"INFO received client ID from server: {self.client_id}")
@@ -154,12 +199,22 @@ class Game:
             print("WARNING Server is ahead. Did we pause the game?")
             # TODO IMPORTANT we should be doing something about it...
 
-        # Load
-        self.state.from_json(data[communication.STATE_KEY])
-
-        # Clear inputs that came before the server frame
+        # Clear inputs and checksums that came before the server frame
         while self.inputs and self.inputs[0][0] < server_frame:
             self.inputs.pop(0)
+        for frame in [frame for frame in self.checksums if frame < server_frame]:
+            self.checksums.pop(frame)
+
+        # Our prediction was correct: there is no need to reload and replay the state,
+        # because we would obtain the exact same result.
+        server_checksum = data.get(communication.CHECKSUM_KEY)
+        if server_checksum is not None and server_checksum == self.checksums.get(
+            server_frame
+        ):
+            return
+
+        # Load
+        self.state.from_json(data[communication.STATE_KEY])
 
         # Re-apply all inputs
         for frame in range(server_frame + 1, self.frame + 1):
@@ -172,6 +227,7 @@ class Game:
                     break
             self.state.set_inputs(self.client_id, inputs)
             self.state.update()
+            self.checksums[frame] = self.state.checksum
 
     def send_command(self, command: str, data: dict[str, t.Any]) -> None:
         """
@@ -180,3 +236,34 @@ class Game:
         if self.client_id:
             data[communication.CLIENT_ID_KEY] = self.client_id
         communication.send_command(self.socket, command, data)
+
+
+class Spectator(Game):
+    """
+    Spectators don't play: they only display the states received from the server.
+    """
+
+    def __init__(self, host: str | None = None, port: int | None = None) -> None:
+        super().__init__(host, port)
+        self.subscription = Subscription(self.socket)
+        self.has_state = False
+
+    def heartbeat(self) -> None:
+        """
+        Refresh the subscription.
+        """
+        self.subscription.send()
+
+    def draw(self) -> None:
+        if self.has_state:
+            self.state.draw()
+        else:
+            self.draw_connecting()
+
+    def on_spectate(self, data: dict[str, t.Any]) -> None:
+        self.subscription.on_nonce(data)
+
+    def on_state(self, data: dict[str, t.Any]) -> None:
+        # There is no prediction to reconcile
+        self.state.from_json(data[communication.STATE_KEY])
+        self.has_state = True
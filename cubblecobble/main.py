@@ -10,17 +10,171 @@
 # site: https://github.com/regisb/cubblecobble
 # license: AGPL v3.0
 # version: 1.0
-import sys
+import argparse
 
 import game
+import netsim
+import relay
 import server
+from profiler import Profiler
 
 
 def main() -> None:
-    if len(sys.argv) == 1 or sys.argv[1] == "play":
-        game.run()
-    elif sys.argv[1] == "serve":
-        server.run()
+    parser = argparse.ArgumentParser(description="Cubble Cobble")
+    profile_parser = argparse.ArgumentParser(add_help=False)
+    profile_parser.add_argument(
+        "--profile", action="store_true", help="Profile a fraction of game loops"
+    )
+    profile_parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=0.1,
+        help="Fraction of game loops to profile (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=0.001,
+        help="Time between two stack samples, in seconds (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--profile-output",
+        default=".",
+        help="Directory where collapsed stacks are written on exit or SIGUSR1 (default: %(default)s)",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("play", parents=[profile_parser], help="Run game client")
+    subparsers.add_parser("serve", parents=[profile_parser], help="Run game server")
+    spectate_parser = subparsers.add_parser(
+        "spectate",
+        parents=[profile_parser],
+        help="Watch a game from a game server or a relay",
+    )
+    spectate_parser.add_argument(
+        "--host", help="Defaults to the GAME_SERVER_HOST environment variable"
+    )
+    spectate_parser.add_argument(
+        "--port",
+        type=int,
+        default=relay.DEFAULT_PORT,
+        help="Relay port (default: %(default)s)",
+    )
+    relay_parser = subparsers.add_parser(
+        "relay", help="Re-broadcast game server snapshots to spectators"
+    )
+    relay_parser.add_argument(
+        "--port",
+        type=int,
+        default=relay.DEFAULT_PORT,
+        help="Port on which spectators connect (default: %(default)s)",
+    )
+    relay_parser.add_argument(
+        "--upstream-host",
+        help="Game server or relay. Defaults to the GAME_SERVER_HOST environment variable",
+    )
+    relay_parser.add_argument(
+        "--upstream-port",
+        type=int,
+        help="Defaults to the GAME_SERVER_PORT environment variable",
+    )
+    relay_parser.add_argument(
+        "--snapshot-interval",
+        type=int,
+        default=1,
+        help="Forward only one every N snapshots (default: %(default)s)",
+    )
+    relay_parser.add_argument(
+        "--max-spectators",
+        type=int,
+        default=256,
+        help="Maximum number of spectators (default: %(default)s)",
+    )
+    netsim_parser = subparsers.add_parser(
+        "netsim",
+        help="Simulate latency, jitter, loss, reordering and duplication between clients and a game server",
+    )
+    netsim_parser.add_argument(
+        "--port",
+        type=int,
+        default=5262,
+        help="Port on which clients connect (default: %(default)s)",
+    )
+    netsim_parser.add_argument(
+        "--upstream-host",
+        help="Game server. Defaults to the GAME_SERVER_HOST environment variable",
+    )
+    netsim_parser.add_argument(
+        "--upstream-port",
+        type=int,
+        help="Defaults to the GAME_SERVER_PORT environment variable",
+    )
+    netsim_parser.add_argument(
+        "--latency", type=float, default=0.05, help="One-way latency in seconds"
+    )
+    netsim_parser.add_argument(
+        "--jitter", type=float, default=0.01, help="Latency variation in seconds"
+    )
+    netsim_parser.add_argument(
+        "--loss", type=float, default=0.01, help="Probability of dropping a packet"
+    )
+    netsim_parser.add_argument(
+        "--duplicate",
+        type=float,
+        default=0.0,
+        help="Probability of duplicating a packet",
+    )
+    netsim_parser.add_argument(
+        "--reorder",
+        type=float,
+        default=0.0,
+        help="Probability of delaying a packet such that it is overtaken",
+    )
+    netsim_parser.add_argument("--seed", type=int, help="Random seed")
+    netsim_parser.add_argument(
+        "--duration", type=float, help="Stop after this number of seconds"
+    )
+    args = parser.parse_args()
+
+    command = args.command or "play"
+    profiler = None
+    if getattr(args, "profile", False):
+        profiler = Profiler(
+            command,
+            sample_rate=args.profile_rate,
+            output_dir=args.profile_output,
+            interval=args.profile_interval,
+        )
+        profiler.install()
+
+    if command == "play":
+        game.run(profiler)
+    elif command == "serve":
+        server.run(profiler)
+    elif command == "spectate":
+        game.run(profiler, spectator=True, host=args.host, port=args.port)
+    elif command == "relay":
+        relay.run(
+            args.port,
+            args.upstream_host,
+            args.upstream_port,
+            args.snapshot_interval,
+            args.max_spectators,
+        )
+    elif command == "netsim":
+        netsim.run(
+            port=args.port,
+            upstream_host=args.upstream_host,
+            upstream_port=args.upstream_port,
+            conditions=netsim.Conditions(
+                latency=args.latency,
+                jitter=args.jitter,
+                loss=args.loss,
+                duplicate=args.duplicate,
+                reorder=args.reorder,
+            ),
+            seed=args.seed,
+            duration=args.duration,
+        )
 
 
 if __name__ == "__main__":
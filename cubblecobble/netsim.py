@@ -0,0 +1,264 @@
+import collections
+import heapq
+import random
+import select
+import socket
+import time
+import typing as t
+
+import communication
+
+UPSTREAM = "upstream"
+DOWNSTREAM = "downstream"
+
+
+def run(
+    *,
+    port: int = 5262,
+    upstream_host: str | None = None,
+    upstream_port: int | None = None,
+    conditions: "Conditions | None" = None,
+    seed: int | None = None,
+    duration: float | None = None,
+) -> None:
+    """
+    Run a network simulator between clients and a game server. The same conditions
+    are applied in both directions.
+    """
+    simulator = NetworkSimulator(
+        port=port,
+        upstream_host=upstream_host,
+        upstream_port=upstream_port,
+        upstream=conditions,
+        downstream=conditions,
+        seed=seed,
+    )
+    try:
+        simulator.run(duration)
+    except KeyboardInterrupt:
+        pass
+    simulator.print_stats()
+
+
+class Conditions:
+    """
+    Network conditions in a single direction. Durations are in seconds, and other
+    values are probabilities.
+    """
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        loss: float = 0.0,
+        duplicate: float = 0.0,
+        reorder: float = 0.0,
+        reorder_delay: float = 0.05,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        # Reordered packets are held for an additional random delay, up to
+        # `reorder_delay`, such that they are overtaken by the next packets
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+
+    def __repr__(self) -> str:
+        return (
+            f"latency={self.latency} jitter={self.jitter} loss={self.loss} "
+            f"duplicate={self.duplicate} reorder={self.reorder}"
+        )
+
+
+class Link:
+    """
+    Network conditions and statistics in a single direction.
+    """
+
+    def __init__(self, conditions: Conditions | None = None) -> None:
+        self.conditions = conditions or Conditions()
+        self.stats: collections.Counter[str] = collections.Counter()
+        # Total delay of delivered packets, in seconds
+        self.delay = 0.0
+        # Last delivered sequence number, to detect reordering
+        self.last_delivered = -1
+
+    def print_stats(self, direction: str) -> None:
+        delivered = self.stats["delivered"]
+        average_delay = self.delay / delivered if delivered else 0
+        values = " ".join(f"{key}={value}" for key, value in sorted(self.stats.items()))
+        print(
+            f"INFO {direction} ({self.conditions}): {values} "
+            f"average_delay={average_delay*1000:.1f}ms"
+        )
+
+
+class Sessions:
+    """
+    Per-client sockets, connected to the game server. Clients that we haven't seen in
+    a long while are forgotten.
+    """
+
+    TIMEOUT_SECONDS = 10
+
+    def __init__(
+        self, upstream_host: str | None = None, upstream_port: int | None = None
+    ) -> None:
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.sockets: dict[t.Any, socket.socket] = {}
+        self.addresses: dict[socket.socket, t.Any] = {}
+        self.last_seen_at: dict[t.Any, float] = {}
+        self.cleaned_at = time.time()
+
+    def touch(self, address: t.Any, now: float) -> None:
+        self.last_seen_at[address] = now
+
+    def get(self, address: t.Any) -> socket.socket:
+        session = self.sockets.get(address)
+        if session is None:
+            session = communication.create_client_socket(
+                self.upstream_host, self.upstream_port
+            )
+            self.sockets[address] = session
+            self.addresses[session] = address
+        return session
+
+    def clean(self, now: float) -> None:
+        if now - self.cleaned_at <= self.TIMEOUT_SECONDS:
+            return
+        for address, last_seen_at in list(self.last_seen_at.items()):
+            if last_seen_at < now - self.TIMEOUT_SECONDS:
+                self.last_seen_at.pop(address)
+                session = self.sockets.pop(address, None)
+                if session is not None:
+                    self.addresses.pop(session)
+                    session.close()
+        self.cleaned_at = now
+
+
+class NetworkSimulator:
+    """
+    UDP proxy which sits between clients and a game server, and degrades traffic.
+
+    Clients connect to the simulator instead of the game server. Each client is
+    forwarded through its own socket, such that the game server sees distinct
+    addresses. Randomness is seeded, so that runs are reproducible.
+
+    The simulator can be run from the command line, or scripted by calling `step()`
+    from another loop and reading `links` afterwards.
+    """
+
+    def __init__(
+        self,
+        *,
+        host: str = "0.0.0.0",
+        port: int = 5262,
+        upstream_host: str | None = None,
+        upstream_port: int | None = None,
+        upstream: Conditions | None = None,
+        downstream: Conditions | None = None,
+        seed: int | None = None,
+    ) -> None:
+        self.links = {UPSTREAM: Link(upstream), DOWNSTREAM: Link(downstream)}
+        self.random = random.Random(seed)
+        self.socket = communication.create_server_socket(host, port)
+        self.sessions = Sessions(upstream_host, upstream_port)
+
+        # Packets to deliver. Each entry is:
+        # (deliver at, sequence, direction, received at, payload, client address)
+        self.queue: list[tuple[float, int, str, float, bytes, t.Any]] = []
+        self.sequence = 0
+
+    def run(self, duration: float | None = None) -> None:
+        t_start = time.time()
+        while duration is None or time.time() - t_start < duration:
+            timeout = 0.1
+            if self.queue:
+                timeout = min(timeout, max(self.queue[0][0] - time.time(), 0))
+            select.select([self.socket, *self.sessions.addresses], [], [], timeout)
+            self.step()
+
+    def step(self, now: float | None = None) -> None:
+        """
+        Receive all available packets and deliver the ones that are due.
+        """
+        if now is None:
+            now = time.time()
+
+        # From clients to the game server
+        while (received := self.receive(self.socket)) is not None:
+            payload, address = received
+            self.sessions.touch(address, now)
+            self.schedule(UPSTREAM, payload, address, now)
+
+        # From the game server to clients
+        for session, address in self.sessions.addresses.items():
+            while (received := self.receive(session)) is not None:
+                self.schedule(DOWNSTREAM, received[0], address, now)
+
+        self.deliver(now)
+        self.sessions.clean(now)
+
+    def receive(self, s: socket.socket) -> tuple[bytes, t.Any] | None:
+        try:
+            received: tuple[bytes, t.Any] | None = communication.receive(s)
+            return received
+        except ConnectionRefusedError:
+            # The game server is not running
+            return None
+
+    def schedule(
+        self, direction: str, payload: bytes, address: t.Any, now: float
+    ) -> None:
+        conditions = self.links[direction].conditions
+        stats = self.links[direction].stats
+        stats["received"] += 1
+        stats["received_bytes"] += len(payload)
+        if self.random.random() < conditions.loss:
+            stats["dropped"] += 1
+            return
+        copies = 1
+        if self.random.random() < conditions.duplicate:
+            stats["duplicated"] += 1
+            copies = 2
+        for _ in range(copies):
+            delay = conditions.latency + self.random.uniform(
+                -conditions.jitter, conditions.jitter
+            )
+            if self.random.random() < conditions.reorder:
+                delay += self.random.uniform(0, conditions.reorder_delay)
+            delay = max(delay, 0)
+            heapq.heappush(
+                self.queue,
+                (now + delay, self.sequence, direction, now, payload, address),
+            )
+            self.sequence += 1
+
+    def deliver(self, now: float) -> None:
+        while self.queue and self.queue[0][0] <= now:
+            _deliver_at, sequence, direction, received_at, payload, address = (
+                heapq.heappop(self.queue)
+            )
+            link = self.links[direction]
+            try:
+                if direction == UPSTREAM:
+                    communication.send_message(self.sessions.get(address), payload)
+                else:
+                    communication.send_message(self.socket, payload, address)
+            except (BlockingIOError, ConnectionRefusedError):
+                link.stats["send_errors"] += 1
+                continue
+            link.stats["delivered"] += 1
+            link.stats["delivered_bytes"] += len(payload)
+            link.delay += now - received_at
+            if sequence < link.last_delivered:
+                link.stats["reordered"] += 1
+            else:
+                link.last_delivered = sequence
+
+    def print_stats(self) -> None:
+        for direction, link in self.links.items():
+            link.print_stats(direction)
@@ -0,0 +1,75 @@
+import constants
+
+
+class OverloadController:
+    """
+    Watch tick durations and decide how much non-essential work the server may do.
+
+    The simulation always runs at full rate. But when ticks get close to the frame
+    budget, the load level is increased, and the server should send fewer snapshots,
+    starting with high-latency clients. The level is decreased again once there is
+    enough headroom for a while.
+    """
+
+    MAX_LEVEL = 3
+    # Load is measured as a fraction of the frame duration
+    HIGH_LOAD = 0.8
+    LOW_LOAD = 0.5
+    SMOOTHING = 0.1
+    # Wait for the effect of a level change before changing it again. We are quick to
+    # shed load and slow to restore it.
+    INCREASE_AFTER_TICKS = constants.FPS // 3
+    DECREASE_AFTER_TICKS = 2 * constants.FPS
+    # Clients that are more than this number of frames away from the server are
+    # considered to have a high latency
+    HIGH_LATENCY_FRAMES = 3
+
+    def __init__(self) -> None:
+        self.level = 0
+        self.load = 0.0
+        self.ticks_since_change = 0
+
+    def record(self, tick_duration: float) -> None:
+        """
+        Update the load level after a tick.
+        """
+        self.load += self.SMOOTHING * (
+            tick_duration / constants.FRAME_DURATION - self.load
+        )
+        self.ticks_since_change += 1
+        if (
+            self.load > self.HIGH_LOAD
+            and self.level < self.MAX_LEVEL
+            and self.ticks_since_change >= self.INCREASE_AFTER_TICKS
+        ):
+            self.set_level(self.level + 1)
+        elif (
+            self.load < self.LOW_LOAD
+            and self.level > 0
+            and self.ticks_since_change >= self.DECREASE_AFTER_TICKS
+        ):
+            self.set_level(self.level - 1)
+
+    def set_level(self, level: int) -> None:
+        print(
+            f"INFO overload level {self.level} -> {level} (load: {self.load*100:.0f}%)"
+        )
+        self.level = level
+        self.ticks_since_change = 0
+
+    @property
+    def is_overloaded(self) -> bool:
+        """
+        Non-critical work should be deferred while this is true.
+        """
+        return self.level > 0
+
+    def snapshot_interval(self, latency_frames: int) -> int:
+        """
+        Return the number of frames between two snapshots sent to a client.
+        """
+        level = self.level
+        if level > 0 and abs(latency_frames) <= self.HIGH_LATENCY_FRAMES:
+            # Low-latency clients are degraded last
+            level -= 1
+        return 1 << level
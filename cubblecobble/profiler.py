@@ -0,0 +1,244 @@
+import atexit
+import collections
+import functools
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import types
+import typing as t
+
+import constants
+
+P = t.ParamSpec("P")
+R = t.TypeVar("R")
+
+
+class Profiler:
+    """
+    Sampling profiler for game loops.
+
+    Only a fraction of the calls to wrapped functions are profiled. During profiled
+    calls, a background thread periodically reads the stack of the calling thread, and
+    each stack is weighted by the time elapsed since the previous sample. Time spent in
+    each call stack is aggregated across calls, and dumped in collapsed-stack format,
+    which can be converted to a flamegraph with flamegraph.pl or speedscope.
+
+    We cannot know in advance that a tick will be slow. So when an unprofiled tick is
+    slower than the frame duration, the next ticks are profiled until a slow one is
+    captured. Slow ticks are aggregated separately. The time spent by the sampling
+    thread is not counted when deciding whether a tick is slow.
+    """
+
+    # Maximum number of ticks that we profile after an unprofiled slow tick
+    MAX_FORCED_TICKS = constants.FPS
+
+    def __init__(
+        self,
+        name: str,
+        sample_rate: float = 0.1,
+        output_dir: str = ".",
+        top: int = 20,
+        interval: float = 0.001,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.sampler = Sampler(interval)
+        self.profile = Profile(os.path.join(output_dir, f"profile-{name}"), top)
+        # Time spent sampling stacks during the last call, in seconds. Callers that
+        # measure the duration of profiled calls should subtract it.
+        self.last_overhead = 0.0
+
+        self._active = False
+        self._forced_ticks = 0
+        self._dump_requested = False
+
+    def install(self) -> None:
+        """
+        Dump results on exit, and on SIGUSR1 when available.
+        """
+        atexit.register(self.dump)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def wrap(self, func: t.Callable[P, R]) -> t.Callable[P, R]:
+        @functools.wraps(func)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            return self.call(func, *args, **kwargs)
+
+        return wrapper
+
+    def call(self, func: t.Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+        """
+        Call a function and maybe profile it.
+        """
+        if self._active:
+            # Nested call, which is already profiled
+            return func(*args, **kwargs)
+
+        profiled = self._forced_ticks > 0 or random.random() < self.sample_rate
+        if profiled:
+            self.sampler.start()
+        self._active = True
+        t_start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            self._active = False
+            if profiled:
+                self.sampler.stop()
+        self.last_overhead = self.sampler.overhead if profiled else 0.0
+        duration = time.perf_counter() - t_start - self.last_overhead
+        is_slow = duration > constants.FRAME_DURATION
+
+        if profiled:
+            self.profile.add(self.sampler.stacks, is_slow)
+            if is_slow:
+                self._forced_ticks = 0
+            elif self._forced_ticks > 0:
+                self._forced_ticks -= 1
+        elif is_slow:
+            self._forced_ticks = self.MAX_FORCED_TICKS
+
+        if self._dump_requested:
+            self._dump_requested = False
+            self.dump()
+        return result
+
+    def _on_signal(self, _signum: int, _frame: types.FrameType | None) -> None:
+        # Don't dump from the signal handler, which might interrupt a sampled tick
+        self._dump_requested = True
+
+    def dump(self) -> None:
+        self.profile.dump()
+
+
+class Sampler:
+    """
+    Background thread which periodically reads the stack of a sampled thread, between
+    calls to `start()` and `stop()`.
+    """
+
+    def __init__(self, interval: float) -> None:
+        # Time between two stack samples, in seconds. Note that the sampling thread
+        # must acquire the GIL, so the actual interval might be longer.
+        self.interval = interval
+        # Time spent in each call stack during the current call, in nanoseconds. Keys
+        # are ";"-separated function names.
+        self.stacks: collections.Counter[str] = collections.Counter()
+        # Time spent sampling stacks during the current call, in seconds
+        self.overhead = 0.0
+
+        # State shared with the sampling thread
+        self.lock = threading.Lock()
+        self.sampling = threading.Event()
+        self.thread_id = 0
+        self.last_sample_at = 0
+        threading.Thread(target=self.sample_forever, daemon=True).start()
+
+    def start(self) -> None:
+        """
+        Start sampling the calling thread.
+        """
+        with self.lock:
+            self.thread_id = threading.get_ident()
+            self.stacks.clear()
+            self.overhead = 0.0
+            self.last_sample_at = time.perf_counter_ns()
+            self.sampling.set()
+
+    def stop(self) -> None:
+        # Once we hold the lock, the sampling thread is done with the current call
+        with self.lock:
+            self.sampling.clear()
+
+    def sample_forever(self) -> None:
+        """
+        Run in the sampling thread.
+        """
+        while True:
+            self.sampling.wait()
+            time.sleep(self.interval)
+            with self.lock:
+                if self.sampling.is_set():
+                    self.sample()
+
+    def sample(self) -> None:
+        now = time.perf_counter_ns()
+        # pylint: disable=protected-access
+        frame = sys._current_frames().get(self.thread_id)
+        names: list[str] = []
+        # Profiled stacks start at the outermost profiler call, which is not
+        # necessarily the closest one, because wrapped functions may be nested
+        depth = 0
+        while frame is not None:
+            if frame.f_code is CALL_CODE:
+                depth = len(names)
+            # Skip profiler frames, such as the wrappers or waiting for the lock
+            module = frame.f_globals.get("__name__")
+            if module != __name__:
+                names.append(f"{module}.{frame.f_code.co_qualname}")
+            frame = frame.f_back
+        if depth:
+            stack = ";".join(reversed(names[:depth]))
+            self.stacks[stack] += now - self.last_sample_at
+        self.last_sample_at = now
+        self.overhead += (time.perf_counter_ns() - now) / 1e9
+
+
+class Profile:
+    """
+    Time spent in each call stack, aggregated across profiled calls. Slow calls are
+    also aggregated separately.
+    """
+
+    def __init__(self, path: str, top: int) -> None:
+        # Output path, without extension
+        self.path = path
+        self.top = top
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.slow_stacks: collections.Counter[str] = collections.Counter()
+        self.ticks = 0
+        self.slow_ticks = 0
+
+    def add(self, stacks: t.Mapping[str, int], is_slow: bool) -> None:
+        self.ticks += 1
+        self.stacks.update(stacks)
+        if is_slow:
+            self.slow_ticks += 1
+            self.slow_stacks.update(stacks)
+
+    def dump(self) -> None:
+        """
+        Write collapsed stacks to file and print the most expensive functions.
+        """
+        if not self.ticks:
+            return
+        path = f"{self.path}.folded"
+        write_collapsed_stacks(path, self.stacks)
+        print(f"INFO {self.ticks} profiled ticks written to {path}")
+        if self.slow_ticks:
+            path = f"{self.path}-slow.folded"
+            write_collapsed_stacks(path, self.slow_stacks)
+            print(f"INFO {self.slow_ticks} slow ticks written to {path}")
+
+        # Aggregate time per function
+        self_times: collections.Counter[str] = collections.Counter()
+        for stack, duration in self.stacks.items():
+            self_times[stack.rsplit(";", 1)[-1]] += duration
+        print(f"INFO top {self.top} functions by self time, per tick:")
+        for name, duration in self_times.most_common(self.top):
+            print(f"  {duration/1e6/self.ticks:8.3f} ms  {name}")
+
+
+CALL_CODE = Profiler.call.__code__
+
+
+def write_collapsed_stacks(path: str, stacks: t.Mapping[str, int]) -> None:
+    """
+    Durations are written in microseconds.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, duration in sorted(stacks.items()):
+            f.write(f"{stack} {duration // 1000}\n")
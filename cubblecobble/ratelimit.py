@@ -0,0 +1,62 @@
+import math
+import typing as t
+
+import constants
+from timers import TimerWheel
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float) -> None:
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+    """
+    Per-address token bucket.
+
+    Each address may send `rate` messages per second on average, with bursts of up to
+    `burst` messages. A bucket is discarded once it would have been refilled, which is
+    equivalent to keeping it.
+
+    At most `max_addresses` buckets are stored, such that spoofed addresses cannot
+    exhaust memory. When that number is reached, messages from new addresses are
+    rejected until existing buckets are discarded.
+    """
+
+    def __init__(self, rate: float, burst: float, max_addresses: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_addresses = max_addresses
+        self.timeout_ticks = math.ceil(burst / rate * constants.FPS)
+        self.buckets: dict[t.Any, TokenBucket] = {}
+        self.timeouts: TimerWheel[t.Any] = TimerWheel()
+
+    def allow(self, address: t.Any, now: float) -> bool:
+        """
+        Consume a token from the address bucket. Return False if the bucket is empty.
+        """
+        bucket = self.buckets.get(address)
+        if bucket is None:
+            if len(self.buckets) >= self.max_addresses:
+                return False
+            bucket = self.buckets[address] = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate
+            )
+            bucket.updated_at = now
+        self.timeouts.schedule(address, self.timeout_ticks)
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def advance(self) -> None:
+        """
+        Move on to the next tick and forget about idle addresses.
+        """
+        for address in self.timeouts.advance():
+            self.buckets.pop(address)
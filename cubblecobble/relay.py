@@ -0,0 +1,164 @@
+import select
+import time
+
+import communication
+import constants
+from ratelimit import RateLimiter
+from spectators import Spectators, Subscription
+
+DEFAULT_PORT = 5261
+
+
+def run(
+    port: int = DEFAULT_PORT,
+    upstream_host: str | None = None,
+    upstream_port: int | None = None,
+    snapshot_interval: int = 1,
+    max_spectators: int = 256,
+) -> None:
+    """
+    Run a relay, which will try to subscribe to a game server or to another relay.
+    """
+    relay = Relay(
+        port=port,
+        upstream_host=upstream_host,
+        upstream_port=upstream_port,
+        snapshot_interval=snapshot_interval,
+        max_spectators=max_spectators,
+    )
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+
+
+class Relay:
+    """
+    Re-broadcast the snapshots of a game server to read-only spectators.
+
+    The relay subscribes once to the upstream snapshot stream, as a spectator. Snapshots
+    are forwarded to spectators as soon as they arrive, without being decoded or
+    encoded again. Since relays behave like game servers for spectators, they can be
+    chained.
+    """
+
+    SPECTATOR_TIMEOUT_FRAMES = 5 * constants.FPS
+    # Spectators only send subscriptions, once per second
+    RATE_LIMIT_PER_SECOND = 2
+    RATE_LIMIT_BURST = 10
+    MAX_RATE_LIMITED_ADDRESSES = 10000
+    MAX_RECEIVED_PACKETS_PER_STEP = 1000
+
+    def __init__(
+        self,
+        *,
+        host: str = "0.0.0.0",
+        port: int = DEFAULT_PORT,
+        upstream_host: str | None = None,
+        upstream_port: int | None = None,
+        snapshot_interval: int = 1,
+        max_spectators: int = 256,
+    ) -> None:
+        # Only forward one every `snapshot_interval` snapshots
+        self.snapshot_interval = max(snapshot_interval, 1)
+        self.snapshots_received = 0
+
+        self.spectators = Spectators(max_spectators, self.SPECTATOR_TIMEOUT_FRAMES)
+        self.rate_limiter = RateLimiter(
+            self.RATE_LIMIT_PER_SECOND,
+            self.RATE_LIMIT_BURST,
+            self.MAX_RATE_LIMITED_ADDRESSES,
+        )
+
+        self.upstream = Subscription(
+            communication.create_client_socket(upstream_host, upstream_port)
+        )
+        self.socket = communication.create_server_socket(host, port)
+        # Subscriptions and timeouts are managed once per frame
+        self.next_frame_at = 0.0
+
+    def run(self) -> None:
+        while True:
+            timeout = max(self.next_frame_at - time.time(), 0)
+            select.select([self.upstream.socket, self.socket], [], [], timeout)
+            self.step(time.time())
+
+    def step(self, now: float) -> None:
+        """
+        Forward all available snapshots, process subscriptions, and run housekeeping if
+        a frame has elapsed.
+        """
+        self.receive_from_upstream()
+        self.receive_subscriptions(now)
+        if now >= self.next_frame_at:
+            self.update(now)
+            self.next_frame_at = now + constants.FRAME_DURATION
+
+    def update(self, now: float) -> None:
+        self.upstream.refresh(now)
+        self.rate_limiter.advance()
+        self.spectators.advance()
+
+    def receive_from_upstream(self) -> None:
+        while True:
+            try:
+                received = communication.receive(self.upstream.socket)
+            except ConnectionRefusedError:
+                # Upstream is not running (yet)
+                return
+            if received is None:
+                return
+            encoded, _address = received
+            if communication.is_command(encoded, communication.COMMAND_STATE):
+                self.forward(encoded)
+            elif communication.is_command(encoded, communication.COMMAND_SPECTATE):
+                self.on_upstream_nonce(encoded)
+
+    def on_upstream_nonce(self, encoded: bytes) -> None:
+        """
+        Complete the subscription handshake with the upstream.
+        """
+        message = communication.decode(encoded)
+        if message is None:
+            return
+        _command, data = communication.parse_command(message)
+        self.upstream.on_nonce(data)
+
+    def forward(self, snapshot: bytes) -> None:
+        self.snapshots_received += 1
+        if self.snapshots_received % self.snapshot_interval != 0:
+            return
+        for address in self.spectators:
+            try:
+                communication.send_message(self.socket, snapshot, address)
+            except BlockingIOError:
+                print(f"WARNING Could not communicate with spectator: {address}")
+
+    def receive_subscriptions(self, now: float) -> None:
+        for _ in range(self.MAX_RECEIVED_PACKETS_PER_STEP):
+            received = communication.receive(self.socket)
+            if received is None:
+                return
+            encoded, address = received
+            if not self.rate_limiter.allow(address, now):
+                continue
+            if not communication.is_message(encoded):
+                continue
+            message = communication.decode(encoded)
+            if message is None:
+                continue
+            command, data = communication.parse_command(message)
+            if command != communication.COMMAND_SPECTATE:
+                print(f"WARNING Unrecognized command '{command}' from: {address}")
+            elif not self.spectators.check(address, data.get(communication.NONCE_KEY)):
+                try:
+                    communication.send_command(
+                        self.socket,
+                        communication.COMMAND_SPECTATE,
+                        {communication.NONCE_KEY: self.spectators.nonce(address)},
+                        address,
+                    )
+                except BlockingIOError:
+                    print(f"WARNING Could not communicate with spectator: {address}")
+            else:
+                self.spectators.subscribe(address)
@@ -1,26 +1,50 @@
 import bisect
 import time
 import typing as t
-import uuid
 
 import communication
 import constants
+from checkpoint import Checkpoint
+from clients import Clients
+from profiler import Profiler
+from ratelimit import RateLimiter
+from spectators import Spectators
 from state import initialize as initialize_pyxel
 from state import State
+from telemetry import Telemetry
 
 
-def run() -> None:
+def run(profiler: Profiler | None = None) -> None:
     # Initialize pyxel just once
     initialize_pyxel("Cubble Cobble - Server")
+    # The checkpoint is shared across restarts, such that clients are preserved
+    checkpoint = Checkpoint(port=Server.DEFAULT_PORT)
     while True:
-        # Always restart server in case of crash
+        # Errors that happen while creating the server, such as an address that is
+        # already in use, are not recoverable
         server = Server()
         try:
-            server.run()
+            server.restore(checkpoint)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"ERROR could not restore checkpoint: {e}")
+            print("WARNING discarding checkpoint")
+            checkpoint.invalidate()
+            server.socket.close()
+            continue
+        # Always restart server in case of crash
+        saves = checkpoint.saves
+        try:
+            server.run(profiler, checkpoint)
         except KeyboardInterrupt:
             return
         except Exception as e:  # pylint: disable=broad-exception-caught
             print(f"ERROR {e}")
+            if checkpoint.saves == saves:
+                # We crashed before saving anything, maybe because of the restored
+                # state: don't restore it again, and don't restart in a tight loop.
+                print("WARNING discarding checkpoint")
+                checkpoint.invalidate()
+                time.sleep(1)
             server.socket.close()
 
 
@@ -30,40 +54,69 @@ class Server:
     """
 
     BUFFER_SIZE = 1024
-
-    def __init__(self, host: str = "0.0.0.0", port: int = 5260) -> None:
-        # TODO move all these dicts to a single data structure
-        self.client_addresses: dict[str, t.Any] = {}
+    DEFAULT_PORT = 5260
+    # Spectators should connect to relays, so only a few of them are allowed
+    MAX_SPECTATORS = 8
+    # Clients send one state per frame, plus a ping per second. Addresses that send
+    # more than that are throttled.
+    RATE_LIMIT_PER_SECOND = 1.5 * constants.FPS
+    RATE_LIMIT_BURST = 3 * constants.FPS
+    # Spoofed addresses would otherwise create one token bucket each
+    MAX_RATE_LIMITED_ADDRESSES = 10000
+    # Packets that are not processed during a tick are left in the socket buffer, and
+    # they will be processed during the next tick. Rejected packets are cheaper than
+    # processed ones, but not free, so we also stop reading after some time.
+    MAX_PROCESSED_PACKETS_PER_TICK = 2000
+    MAX_RECEIVED_PACKETS_PER_TICK = 2 * MAX_PROCESSED_PACKETS_PER_TICK
+    MAX_RECEIVE_DURATION = constants.FRAME_DURATION / 4
+    CHECKPOINT_INTERVAL_FRAMES = 5
+
+    def __init__(self, host: str = "0.0.0.0", port: int = DEFAULT_PORT) -> None:
+        self.clients = Clients()
         self.state: State = State()
-        # Each series of inputs is (frame, client_id, inputs)
-        # This list should be kept sorted by frame.
-        self.client_inputs: dict[str, list[tuple[int, str, list[int]]]] = {}
-        self.client_last_seen_at: dict[str, float] = {}
-
-        self.socket = communication.create_server_socket(host, port)
+        # Spectators receive snapshots but don't play. They are usually relays, which
+        # re-broadcast snapshots to many more spectators. Spectators must subscribe
+        # again before their timer expires.
+        self.spectators = Spectators(self.MAX_SPECTATORS, Clients.TIMEOUT_FRAMES)
+        self.rate_limiter = RateLimiter(
+            self.RATE_LIMIT_PER_SECOND,
+            self.RATE_LIMIT_BURST,
+            self.MAX_RATE_LIMITED_ADDRESSES,
+        )
+        self.telemetry = Telemetry()
         self.frame = 0
+        self.socket = communication.create_server_socket(host, port)
 
-    def run(self) -> None:
+    def run(
+        self, profiler: Profiler | None = None, checkpoint: Checkpoint | None = None
+    ) -> None:
         """
         https://docs.python.org/3/library/socket.html#example
         """
         # Note that we initialize pyxel, because we need to load tilemaps. But we don't
         # pyxel.run(...) because that would pause the server window too frequently.
         while True:
-            self.update()
+            t_start = time.time()
+            overhead = 0.0
+            if profiler:
+                profiler.call(self.update)
+                overhead = profiler.last_overhead
+            else:
+                self.update()
+            if checkpoint and self.frame % self.CHECKPOINT_INTERVAL_FRAMES == 0:
+                self.save(checkpoint)
+            self.sleep(t_start, overhead)
 
     def update(self) -> None:
         """
         Run a single game loop.
         """
-        t_start = time.time()
-
         # Receive and process messages
-        for message, address in communication.receive_all(self.socket):
-            self.process(message, address)
+        self.receive_all(time.time())
 
         # Process inputs
-        for client_id, inputs in self.client_inputs.items():
+        for client_id, client in self.clients.items():
+            inputs = client.inputs
             # Clean outdated inputs
             while inputs and inputs[0][0] < self.frame:
                 inputs.pop(0)
@@ -79,59 +132,191 @@ class Server:
         self.state.update()
 
         # Get rid of clients that we haven't seen in a long while
-        clients_to_remove = []
-        remove_after_seconds = 5
-        for client_id, last_seen_at in self.client_last_seen_at.items():
-            if last_seen_at < time.time() - remove_after_seconds:
-                clients_to_remove.append(client_id)
-        for client_id in clients_to_remove:
+        for client_id in self.clients.advance():
             print(f"Removing outdated client: {client_id}")
-            self.client_addresses.pop(client_id)
-            self.client_inputs.pop(client_id)
-            self.client_last_seen_at.pop(client_id)
             self.state.remove_client(client_id)
+        self.spectators.advance()
 
         # Share state with all clients
-        for client_id in self.client_addresses:
-            self.send(
-                client_id,
-                communication.COMMAND_STATE,
-                {
-                    communication.FRAME_KEY: self.frame,
-                    communication.STATE_KEY: self.state.to_json(),
-                },
-            )
+        self.send_snapshots()
+        self.send_pings()
+
+        if self.telemetry.should_print(self.frame):
+            self.telemetry.print(self.frame, len(self.clients))
 
-        # Sleep until end of frame, thus maintaining a constant framerate
         self.frame += 1  # TODO we should sometimes loop over
+
+    def sleep(self, t_start: float, overhead: float = 0.0) -> None:
+        """
+        Sleep until end of frame, thus maintaining a constant framerate.
+
+        Profiling overhead is not taken into account when measuring the server load.
+        """
         time_elapsed = time.time() - t_start
-        if time_elapsed > constants.FRAME_DURATION:
+        tick_duration = time_elapsed - overhead
+        self.telemetry.overload.record(tick_duration)
+        if tick_duration > constants.FRAME_DURATION:
             print(
-                f"WARNING slow frame: {time_elapsed}s ({time_elapsed*100/constants.FRAME_DURATION})%"
+                f"WARNING slow frame: {tick_duration}s ({tick_duration*100/constants.FRAME_DURATION})%"
             )
-        else:
+        if time_elapsed < constants.FRAME_DURATION:
             time.sleep(constants.FRAME_DURATION - time_elapsed)
 
-    def process(self, message: dict[str, t.Any], address: str) -> None:
+    def send_snapshots(self) -> None:
+        """
+        Send the current state to all clients. The message is encoded just once.
+
+        When the server is overloaded, clients receive fewer snapshots. Clients that
+        skip the same frames are spread over consecutive ticks.
+        """
+        if not self.clients and not self.spectators:
+            return
+        message = communication.encode_command(
+            communication.COMMAND_STATE,
+            {
+                communication.FRAME_KEY: self.frame,
+                communication.CHECKSUM_KEY: self.state.checksum,
+                communication.STATE_KEY: self.state.to_json(),
+            },
+        )
+        overload = self.telemetry.overload
+        counters = self.telemetry.counters
+        for index, (_client_id, client) in enumerate(self.clients.items()):
+            interval = overload.snapshot_interval(client.latency)
+            if (self.frame + index) % interval != 0:
+                counters["snapshots_skipped"] += 1
+                continue
+            self.send_message_to(client.address, message)
+            counters["snapshots_sent"] += 1
+
+        # Spectators are not sensitive to latency, so they are degraded first
+        spectator_interval = overload.snapshot_interval(
+            overload.HIGH_LATENCY_FRAMES + 1
+        )
+        if self.frame % spectator_interval == 0:
+            for address in self.spectators:
+                self.send_message_to(address, message)
+                counters["snapshots_sent_to_spectators"] += 1
+
+    def send_pings(self) -> None:
+        """
+        Respond to pings received during this tick.
+        """
+        for _client_id, client in self.clients.items():
+            if client.ping_time is None:
+                continue
+            self.send_to(
+                client.address,
+                communication.COMMAND_PING,
+                {
+                    communication.TIME_KEY: client.ping_time,
+                    communication.FRAME_KEY: self.frame,
+                },
+            )
+            client.ping_time = None
+
+    def save(self, checkpoint: Checkpoint) -> None:
+        """
+        Checkpoint clients, positions and the next frame.
+        """
+        # Clients are stored in the same order in clients and in the state
+        checkpoint.save(
+            self.frame,
+            (
+                (client_id, client.address, position)
+                for (client_id, client), position in zip(
+                    self.clients.items(), self.state.positions
+                )
+            ),
+        )
+
+    def restore(self, checkpoint: Checkpoint) -> None:
+        """
+        Resume from the last checkpoint, if any. Clients keep their IDs, so they don't
+        need to reconnect.
+        """
+        restored = checkpoint.load(Clients.TIMEOUT_FRAMES * constants.FRAME_DURATION)
+        if restored is None:
+            return
+        frame, saved_at, clients = restored
+        # Clients kept running while we were down, so we catch up with them
+        self.frame = frame + int((time.time() - saved_at) * constants.FPS)
+        for client_id, address, position in clients:
+            self.clients.add(client_id, address)
+            self.state.add_client(client_id)
+            restored_position = self.state.positions[-1]
+            restored_position.x, restored_position.y = position.x, position.y
+            restored_position.vx, restored_position.vy = position.vx, position.vy
+        self.state.update_checksum()
+        print(
+            f"INFO restored {len(clients)} clients from frame {frame}, resuming at frame {self.frame}"
+        )
+
+    def receive_all(self, now: float) -> None:
+        """
+        Receive and process a bounded number of messages.
+
+        Messages are rejected before being decoded if the sender exceeds its rate
+        limit or if they are obviously malformed. Counters are only updated at the end,
+        to keep the rejection path cheap.
+        """
+        self.rate_limiter.advance()
+        counters = self.telemetry.counters
+        received_count = rate_limited = malformed = processed = 0
+        stop_at = time.perf_counter() + self.MAX_RECEIVE_DURATION
+        for _ in range(self.MAX_RECEIVED_PACKETS_PER_TICK):
+            if processed >= self.MAX_PROCESSED_PACKETS_PER_TICK:
+                counters["ticks_over_packet_budget"] += 1
+                break
+            if time.perf_counter() > stop_at:
+                counters["ticks_over_receive_duration"] += 1
+                break
+            received = communication.receive(self.socket)
+            if received is None:
+                break
+            encoded, address = received
+            received_count += 1
+            if not self.rate_limiter.allow(address, now):
+                rate_limited += 1
+                continue
+            if not communication.is_message(encoded):
+                malformed += 1
+                continue
+            message = communication.decode(encoded)
+            if message is None:
+                malformed += 1
+                continue
+            self.process(message, address, now)
+            processed += 1
+        counters["packets_received"] += received_count
+        counters["packets_rate_limited"] += rate_limited
+        counters["packets_malformed"] += malformed
+        counters["packets_processed"] += processed
+
+    def process(self, message: dict[str, t.Any], address: str, now: float) -> None:
         # Parse command
         command, data = communication.parse_command(message)
 
         # Connect
         if command == communication.COMMAND_CONNECT:
-            self.on_connect(address)
+            self.on_connect(address, now)
             return
         # Ping
         if command == communication.COMMAND_PING:
             self.on_ping(address, data)
             return
+        # Spectate
+        if command == communication.COMMAND_SPECTATE:
+            self.on_spectate(address, data)
+            return
 
         # Parse client ID
         client_id = data.get(communication.CLIENT_ID_KEY, "")
-        if client_id not in self.client_addresses:
+        if client_id not in self.clients:
             print(f"WARNING invalid client ID: '{client_id}' for command: '{command}'")
             return
         # Update client address
-        self.client_addresses[client_id] = address
+        self.clients.set_address(client_id, address)
 
         # State update
         if command == communication.COMMAND_STATE:
@@ -143,32 +328,47 @@ class Server:
         """
         Send some JSON-formatted data to a client.
         """
-        self.send_to(self.client_addresses[client_id], command, data)
+        self.send_to(self.clients[client_id].address, command, data)
 
     def send_to(self, address: t.Any, command: str, data: dict[str, t.Any]) -> None:
         """
         Send some JSON-formatted data to an address.
         """
+        self.send_message_to(address, communication.encode_command(command, data))
+
+    def send_message_to(self, address: t.Any, message: bytes) -> None:
+        """
+        Send an already encoded message to an address.
+        """
         try:
-            communication.send_command(self.socket, command, data, address)
+            communication.send_message(self.socket, message, address)
         except BlockingIOError:
             print(f"WARNING Could not communicate with client: {address}")
 
-    def on_connect(self, address: str) -> None:
+    def on_connect(self, address: t.Any, now: float) -> None:
         """
         Connect a new client
 
         The client ID is sent back to the client, which is then responsible for storing it.
-        """
-        client_id = str(uuid.uuid4())
+        If the address already owns a client, no new client is created: the existing
+        client ID is sent again, in case the previous response was lost.
 
-        # Add new client
-        self.client_addresses[client_id] = address
-        self.client_inputs[client_id] = []
-        self.client_last_seen_at[client_id] = time.time()
-        self.state.add_client(client_id)
-
-        print(f"INFO connected new client f{client_id} to {address}")
+        Refused connections are silently ignored: clients try again later.
+        """
+        counters = self.telemetry.counters
+        if not self.clients.allow_connect(address, now):
+            counters["connects_rate_limited"] += 1
+            return
+        client_id = self.clients.get_id(address)
+        if client_id is not None:
+            counters["connects_refused"] += 1
+        elif self.clients.is_full:
+            counters["connects_over_capacity"] += 1
+            return
+        else:
+            client_id = self.clients.connect(address)
+            self.state.add_client(client_id)
+            print(f"INFO connected new client f{client_id} to {address}")
 
         # Tell client about its client ID, such that they can send it back
         self.send(
@@ -177,19 +377,51 @@ class Server:
             {communication.CLIENT_ID_KEY: client_id},
         )
 
+    def on_spectate(self, address: t.Any, data: dict[str, t.Any]) -> None:
+        """
+        Subscribe an address to snapshots, or refresh its subscription.
+
+        Addresses that don't send a valid nonce receive one, which they must send back.
+        """
+        if not self.spectators.check(address, data.get(communication.NONCE_KEY)):
+            self.send_to(
+                address,
+                communication.COMMAND_SPECTATE,
+                {communication.NONCE_KEY: self.spectators.nonce(address)},
+            )
+            return
+        if not self.spectators.subscribe(address):
+            self.telemetry.counters["spectators_refused"] += 1
+
     def on_ping(self, address: t.Any, data: dict[str, t.Any]) -> None:
         """
-        Respond with the same data and the current frame.
+        Respond with the same data and the current frame, at the end of the tick.
+
+        Only clients are answered, such that pings cannot be reflected to spoofed
+        addresses.
         """
-        response_data = {
-            # TODO handle missing field in client data?
-            communication.TIME_KEY: data[communication.TIME_KEY],
-            communication.FRAME_KEY: self.frame,
-        }
-        self.send_to(address, communication.COMMAND_PING, response_data)
+        counters = self.telemetry.counters
+        ping_time = data.get(communication.TIME_KEY)
+        if not isinstance(ping_time, (int, float)):
+            counters["packets_malformed"] += 1
+            return
+        client_id = self.clients.get_id(address)
+        if client_id is None:
+            counters["pings_ignored"] += 1
+            return
+        client = self.clients[client_id]
+        if client.ping_time is not None:
+            counters["pings_coalesced"] += 1
+        client.ping_time = ping_time
 
     def on_state(self, client_id: str, data: dict["str", t.Any]) -> None:
-        client_frame: int = int(data[communication.FRAME_KEY])
+        client_frame = data.get(communication.FRAME_KEY)
+        inputs = data.get(communication.INPUTS_KEY)
+        if not isinstance(client_frame, int) or not isinstance(inputs, list):
+            self.telemetry.counters["packets_malformed"] += 1
+            return
+        client = self.clients[client_id]
+        client.latency = client_frame - self.frame
         if client_frame < self.frame:
             # This is normal if it's the first frame
             if client_frame > 0:
@@ -197,17 +429,12 @@ class Server:
                     f"WARNING received late frame {client_frame} from client: {self.frame - client_frame} frames delay"
                 )
             # TODO ignore state
-        inputs: list[int] = data[communication.INPUTS_KEY]
-        if not isinstance(inputs, list):
-            print(
-                f"WARNING invalid format for inputs: expected list got {inputs.__class__}"
-            )
         if len(inputs) > 3:
             print(f"WARNING Too much inputs from {client_id}: {len(inputs)}")
             inputs = inputs[:3]
         # TODO don't insert inputs twice
         # TODO check inputs are valid
-        bisect.insort(self.client_inputs[client_id], (client_frame, client_id, inputs))
+        bisect.insort(client.inputs, (client_frame, client_id, inputs))
 
-        # Update client last seen date
-        self.client_last_seen_at[client_id] = time.time()
+        # Postpone client removal
+        self.clients.refresh(client_id)
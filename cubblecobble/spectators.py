@@ -0,0 +1,116 @@
+import hashlib
+import hmac
+import os
+import socket
+import typing as t
+
+import communication
+from timers import TimerWheel
+
+
+class Spectators:
+    """
+    Addresses that subscribed to snapshots.
+
+    Spectators receive far more data than they send, so subscribing requires a
+    handshake, such that a spoofed address cannot start a stream: the first
+    subscription is answered with a nonce, which must be sent back in all subsequent
+    subscriptions. Nonces are derived from the address and a secret, so we don't need
+    to store anything before the handshake completes.
+
+    Subscriptions expire after `timeout_ticks` ticks, and their number is capped.
+    """
+
+    def __init__(self, max_spectators: int, timeout_ticks: int) -> None:
+        self.max_spectators = max_spectators
+        self.timeout_ticks = timeout_ticks
+        self.timeouts: TimerWheel[t.Any] = TimerWheel()
+        self.secret = os.urandom(16)
+
+    def __contains__(self, address: t.Any) -> bool:
+        return address in self.timeouts
+
+    def __len__(self) -> int:
+        return len(self.timeouts)
+
+    def __iter__(self) -> t.Iterator[t.Any]:
+        return iter(self.timeouts)
+
+    def nonce(self, address: t.Any) -> str:
+        return hmac.new(
+            self.secret, repr(address).encode(), hashlib.sha256
+        ).hexdigest()[:16]
+
+    def check(self, address: t.Any, nonce: t.Any) -> bool:
+        """
+        Return True if the nonce was sent by this address. Otherwise, the nonce should
+        be sent to the address.
+        """
+        return isinstance(nonce, str) and hmac.compare_digest(
+            nonce, self.nonce(address)
+        )
+
+    def subscribe(self, address: t.Any) -> bool:
+        """
+        Add or refresh a subscription. Return False if there are too many spectators.
+        """
+        if address not in self.timeouts:
+            if len(self.timeouts) >= self.max_spectators:
+                return False
+            print(f"INFO new spectator: {address}")
+        self.timeouts.schedule(address, self.timeout_ticks)
+        return True
+
+    def advance(self) -> None:
+        """
+        Move on to the next tick and forget about outdated spectators.
+        """
+        for address in self.timeouts.advance():
+            print(f"INFO Removing outdated spectator: {address}")
+
+
+class Subscription:
+    """
+    Subscription to the snapshots of a game server or of a relay, on the spectator
+    side.
+
+    The nonce that is sent back by the upstream is included in all subsequent
+    subscriptions. Subscriptions must be refreshed before the upstream drops us.
+    """
+
+    REFRESH_INTERVAL_SECONDS = 1
+
+    def __init__(self, s: socket.socket) -> None:
+        self.socket = s
+        self.nonce = ""
+        self.refreshed_at = 0.0
+
+    def refresh(self, now: float) -> None:
+        """
+        Subscribe again if the last subscription is getting old.
+        """
+        if now - self.refreshed_at >= self.REFRESH_INTERVAL_SECONDS:
+            self.refreshed_at = now
+            self.send()
+
+    def send(self) -> None:
+        data = {}
+        if self.nonce:
+            data[communication.NONCE_KEY] = self.nonce
+        try:
+            communication.send_command(
+                self.socket, communication.COMMAND_SPECTATE, data
+            )
+        except (BlockingIOError, ConnectionRefusedError):
+            print("WARNING Could not subscribe to upstream")
+
+    def on_nonce(self, data: dict[str, t.Any]) -> None:
+        """
+        Complete the subscription handshake.
+        """
+        nonce = data.get(communication.NONCE_KEY)
+        if not isinstance(nonce, str):
+            print(f"WARNING Received invalid nonce from upstream: {nonce}")
+            return
+        self.nonce = nonce
+        self.send()
@@ -1,6 +1,8 @@
+import array
 import hashlib
 import os
 import typing as t
+import zlib
 
 import pyxel
 
@@ -40,12 +42,25 @@ class Commands:
 
 
 class Position:
+    __slots__ = ("x", "y", "vx", "vy")
+
+    x: int
+    y: int
+    vx: int
+    vy: int
 
     def __init__(self) -> None:
-        self.x: int = constants.LEVEL_SIZE_PIXELS // 2 - PLAYER_SIZE
-        self.y: int = constants.LEVEL_SIZE_PIXELS // 2 - PLAYER_SIZE
-        self.vx: int = 0
-        self.vy: int = 0
+        self.reset()
+
+    def reset(self) -> "Position":
+        """
+        Move back to the spawn point.
+        """
+        self.x = constants.LEVEL_SIZE_PIXELS // 2 - PLAYER_SIZE
+        self.y = constants.LEVEL_SIZE_PIXELS // 2 - PLAYER_SIZE
+        self.vx = 0
+        self.vy = 0
+        return self
 
     @property
     def x2(self) -> int:
@@ -55,13 +70,6 @@ class Position:
     def y2(self) -> int:
         return self.y + PLAYER_SIZE - 1
 
-    def to_json(self) -> list[int]:
-        return [self.x, self.y, self.vx, self.vy]
-
-    def from_json(self, data: list[int]) -> "Position":
-        self.x, self.y, self.vx, self.vy = data
-        return self
-
     def update(self, inputs: list[int]) -> None:
         ############# Collect forces
         fx = 0
@@ -162,8 +170,6 @@ class Position:
         tile_id = pyxel.tilemaps[LEVELS_TILEMAP].pget(x_tile, y_tile)
         return tile_id == TILE_WALL
 
-   
-
 
 class State:
 
@@ -171,22 +177,71 @@ class State:
         self.client_ids: list[str] = []  # note that the client IDs are hashed
         self.inputs: list[list[int]] = []
         self.positions: list[Position] = []
+        # Positions of players who left, which are recycled when new players join
+        self._position_pool: list[Position] = []
+        # Checksum of the simulation state, which is refreshed after every change. It is
+        # used by clients to detect whether their prediction matches the server state.
+        # The client IDs part only changes when players join or leave, so we cache it.
+        self._client_ids_checksum = 0
+        # Positions are copied to this buffer before being checksummed. The buffer is
+        # reused across updates, and resized only when players join or leave.
+        self._checksum_buffer = array.array("q")
+        self.checksum = 0
+        self.update_client_ids_checksum()
 
     def to_json(self) -> dict[str, t.Any]:
+        """
+        Positions are serialized as a flat list of (x, y, vx, vy) values, such that
+        decoding does not create one list per player. Inputs are not serialized, because
+        they are cleared at the end of every update.
+        """
+        positions: list[int] = []
+        for position in self.positions:
+            positions += (position.x, position.y, position.vx, position.vy)
         return {
             "client_ids": self.client_ids,
-            "inputs": self.inputs,
-            "positions": [position.to_json() for position in self.positions],
+            "positions": positions,
         }
 
     def from_json(self, data: dict[str, t.Any]) -> "State":
-        self.client_ids = data["client_ids"]
-        self.inputs = data["inputs"]
-        self.positions = [
-            Position().from_json(position) for position in data["positions"]
-        ]
+        """
+        Update the state in-place, reusing existing objects. This is called for every
+        snapshot received by the client, so we try not to allocate anything.
+        """
+        client_ids: list[str] = data["client_ids"]
+        positions: list[int] = data["positions"]
+        client_ids_changed = client_ids != self.client_ids
+        if client_ids_changed:
+            self.client_ids[:] = client_ids
+            self.resize(len(client_ids))
+        for index, position in enumerate(self.positions):
+            offset = 4 * index
+            position.x = positions[offset]
+            position.y = positions[offset + 1]
+            position.vx = positions[offset + 2]
+            position.vy = positions[offset + 3]
+        if client_ids_changed:
+            self.update_client_ids_checksum()
+        else:
+            self.update_checksum()
         return self
 
+    def resize(self, count: int) -> None:
+        """
+        Make sure that there are exactly `count` inputs and positions.
+        """
+        while len(self.positions) > count:
+            self._position_pool.append(self.positions.pop())
+            self.inputs.pop()
+        while len(self.positions) < count:
+            self.positions.append(self.new_position())
+            self.inputs.append([])
+
+    def new_position(self) -> Position:
+        if self._position_pool:
+            return self._position_pool.pop().reset()
+        return Position()
+
     def add_client(self, client_id: str) -> None:
         encoded: str = encode(client_id)
         if encoded in self.client_ids:
@@ -194,13 +249,41 @@ class State:
             return
         self.client_ids.append(encoded)
         self.inputs.append([])
-        self.positions.append(Position())
+        self.positions.append(self.new_position())
+        self.update_client_ids_checksum()
 
     def remove_client(self, client_id: str) -> None:
         client_index = self.get_client_index(client_id)
         self.client_ids.pop(client_index)
         self.inputs.pop(client_index)
-        self.positions.pop(client_index)
+        self._position_pool.append(self.positions.pop(client_index))
+        self.update_client_ids_checksum()
+
+    def update_client_ids_checksum(self) -> None:
+        """
+        Must be called whenever the list of client IDs changes.
+        """
+        self._client_ids_checksum = zlib.crc32("".join(self.client_ids).encode())
+        self.update_checksum()
+
+    def update_checksum(self) -> None:
+        """
+        Compute a checksum of client IDs and positions.
+
+        Note that we cannot rely on hash(...) here, because string hashes are salted
+        differently in the server and client processes.
+        """
+        values = self._checksum_buffer
+        if len(values) != 4 * len(self.positions):
+            values[:] = array.array("q", bytes(32 * len(self.positions)))
+        offset = 0
+        for position in self.positions:
+            values[offset] = position.x
+            values[offset + 1] = position.y
+            values[offset + 2] = position.vx
+            values[offset + 3] = position.vy
+            offset += 4
+        self.checksum = zlib.crc32(values, self._client_ids_checksum)
 
     def draw(self) -> None:
         # Level
@@ -296,6 +379,7 @@ class State:
             position.update(inputs)
         # Clear inputs
         self.inputs = [[] for _ in range(len(self.client_ids))]
+        self.update_checksum()
 
 
 def encode(value: str) -> str:
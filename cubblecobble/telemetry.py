@@ -0,0 +1,40 @@
+import collections
+
+import constants
+from overload import OverloadController
+
+
+class Telemetry:
+    """
+    Counters and load of the game server.
+
+    Counters are reset every time they are printed. Printing is not critical, so it is
+    deferred while the server is overloaded, but it still happens eventually.
+    """
+
+    # Print counters every 10s
+    INTERVAL_FRAMES = 10 * constants.FPS
+    MAX_INTERVAL_FRAMES = 6 * INTERVAL_FRAMES
+
+    def __init__(self) -> None:
+        self.counters: collections.Counter[str] = collections.Counter()
+        self.overload = OverloadController()
+        self.printed_at = 0
+
+    def should_print(self, frame: int) -> bool:
+        frames_since_print = frame - self.printed_at
+        return frames_since_print >= self.INTERVAL_FRAMES and (
+            not self.overload.is_overloaded
+            or frames_since_print >= self.MAX_INTERVAL_FRAMES
+        )
+
+    def print(self, frame: int, clients: int) -> None:
+        stats = " ".join(
+            f"{key}={value}" for key, value in sorted(self.counters.items())
+        )
+        print(
+            f"INFO frame={frame} clients={clients} "
+            f"overload_level={self.overload.level} {stats}"
+        )
+        self.counters.clear()
+        self.printed_at = frame
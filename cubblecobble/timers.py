@@ -0,0 +1,61 @@
+import typing as t
+
+K = t.TypeVar("K", bound=t.Hashable)
+
+
+class TimerWheel(t.Generic[K]):
+    """
+    Hashed timer wheel, to expire keys after a given number of ticks.
+
+    Scheduling, refreshing and cancelling a timer are O(1) operations, and advancing the
+    wheel by one tick costs O(expired timers). Timers that are scheduled further than
+    `size` ticks in the future are kept in their slot until their deadline is reached,
+    so the wheel size should be larger than the usual timeouts.
+    """
+
+    def __init__(self, size: int = 256) -> None:
+        self.slots: list[set[K]] = [set() for _ in range(size)]
+        self.deadlines: dict[K, int] = {}
+        self.tick = 0
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.deadlines
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def __iter__(self) -> t.Iterator[K]:
+        return iter(self.deadlines)
+
+    def schedule(self, key: K, delay: int) -> None:
+        """
+        Expire the key after `delay` ticks. If the key was already scheduled, its
+        deadline is replaced.
+        """
+        deadline = self.tick + max(delay, 1)
+        previous_deadline = self.deadlines.get(key)
+        if previous_deadline == deadline:
+            return
+        if previous_deadline is not None:
+            self.slots[previous_deadline % len(self.slots)].discard(key)
+        self.deadlines[key] = deadline
+        self.slots[deadline % len(self.slots)].add(key)
+
+    def cancel(self, key: K) -> None:
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(key)
+
+    def advance(self) -> list[K]:
+        """
+        Move on to the next tick and return the keys that expired.
+        """
+        self.tick += 1
+        slot = self.slots[self.tick % len(self.slots)]
+        if not slot:
+            return []
+        expired = [key for key in slot if self.deadlines[key] <= self.tick]
+        for key in expired:
+            slot.remove(key)
+            self.deadlines.pop(key)
+        return expired